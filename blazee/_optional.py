@@ -0,0 +1,28 @@
+"""
+blazee._optional
+================
+
+Lookups of optional dependencies, done lazily and at most once per process.
+"""
+import functools
+import importlib
+import importlib.util
+
+
+@functools.lru_cache(maxsize=None)
+def has_module(name):
+    """Returns whether the top-level module `name` is installed,
+    without importing it"""
+    return importlib.util.find_spec(name) is not None
+
+
+@functools.lru_cache(maxsize=None)
+def import_class(module, name):
+    """Imports a class, or returns an empty tuple, matching no instance,
+    if it is not available"""
+    if not has_module(module.split('.')[0]):
+        return ()
+    try:
+        return getattr(importlib.import_module(module), name)
+    except (ImportError, AttributeError):
+        return ()
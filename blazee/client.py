@@ -4,20 +4,33 @@ blazee.client
 
 This module provides a Client for interacting with the Blazee API.
 """
+import gzip
+import itertools
 import logging
 import os
-import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from json import dumps as jsondumps
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.util.retry import Retry
 
 from blazee.model import BlazeeModel, _serialize_model
-from blazee.utils import NumpyEncoder
+from blazee.prediction import Prediction
+from blazee.utils import (ARCHIVE_FORMATS, CONTENT_TYPES, UUID_PATTERN,
+                          SerializedModel, default_codec, json_dumps,
+                          json_loads, msgpack_dumps)
 
 DEFAULT_BLAZEE_HOST = 'https://api.blazee.io/v1'
 
+# Request bodies larger than this are gzip compressed
+GZIP_MIN_SIZE = 4096
+
+# Number of GET responses kept for conditional requests
+ETAG_CACHE_SIZE = 128
+
 
 class Client:
     """Client for interacting with the Blazee API.
@@ -32,9 +45,26 @@ class Client:
         The base URL of the Blazee API. Defaults to
         Blazee production API.
         This can also be set through the BLAZEE_HOST environment variable
+
+    predict_batch_size: int
+        The number of samples sent per request by `predict_many()`
+
+    max_in_flight: int
+        The maximum number of concurrent requests made by `predict_many()`
+
+    codec: string
+        The compression codec of uploaded models, one of 'zstd', 'lz4',
+        'deflate' or 'lzma'. Defaults to 'zstd' when the zstandard package
+        is installed, 'deflate' otherwise.
+
+    compresslevel: int
+        The compression level of uploaded models. Defaults to a fast
+        level for the codec. Not supported by the 'lzma' codec.
     """
 
-    def __init__(self, api_key: str = None, host: str = None):
+    def __init__(self, api_key: str = None, host: str = None,
+                 predict_batch_size: int = 64, max_in_flight: int = 8,
+                 codec: str = None, compresslevel: int = None):
         if not host:
             host = os.environ.get('BLAZEE_HOST')
             if not host:
@@ -46,17 +76,53 @@ class Client:
 
         self.api_key = api_key
         self.host = host
+        self.predict_batch_size = predict_batch_size
+        self.max_in_flight = max_in_flight
+        if not codec:
+            codec = default_codec()
+        if codec not in ARCHIVE_FORMATS:
+            raise ValueError(f'Unsupported compression codec: {codec}')
+        if codec == 'lzma' and compresslevel is not None:
+            raise ValueError('The lzma codec does not support compresslevel')
+        self.codec = codec
+        self.compresslevel = compresslevel
+
+        # Re-use connections across API calls, predictions and uploads,
+        # and retry transient errors
+        self._session = requests.Session()
+        self._session.headers['Connection'] = 'keep-alive'
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=max(32, max_in_flight),
+                              max_retries=Retry(total=5,
+                                                backoff_factor=0.3,
+                                                status_forcelist=[502, 503, 504],
+                                                raise_on_status=False))
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        # ETag and raw body of the last GET responses, by URL, least
+        # recently used first
+        self._etags = OrderedDict()
 
-    def all_models(self):
+    def all_models(self, prefetch_versions=False):
         """Returns a list of all your deployed Blazee models.
 
+        Parameters
+        ----------
+        prefetch_versions: bool
+            Whether to also fetch the versions of every model, with
+            up to `max_in_flight` concurrent requests.
+
         Returns
         -------
         models: list of `blazee.model.BlazeeModel`
         """
         resp = self._api_call('/models')
 
-        return [BlazeeModel(self, m) for m in resp]
+        models = [BlazeeModel(self, m) for m in resp]
+        if prefetch_versions and models:
+            with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+                list(executor.map(BlazeeModel._fetch_versions, models))
+        return models
 
     def get_model(self, model_id):
         """Returns the Blazee model with the given ID.
@@ -65,16 +131,15 @@ class Client:
         -------
         model: `blazee.model.BlazeeModel`
         """
-        try:
-            uuid.UUID(model_id)
-        except ValueError:
+        if not UUID_PATTERN.fullmatch(str(model_id)):
             raise ValueError(f'Malformed model ID: {model_id}')
 
         resp = self._api_call(f'/models/{model_id}')
 
         return BlazeeModel(self, resp)
 
-    def deploy_model(self, model, model_name=None, include_files=None):
+    def deploy_model(self, model, model_name=None, include_files=None,
+                     quantize=None):
         """Deploys a trained ML model on Blazee
         At the moment we support Scikit Learn, Keras and PyTorch models.
         Looking for another framework? Reach out at support@blazee.io
@@ -82,13 +147,18 @@ class Client:
         Parameters
         ----------
         model: one of `sklearn.base.BaseEstimator`, `keras.models.Model`, `torch.nn.Module`
-            The model to deploy
+            The model to deploy. An already serialized
+            `blazee.utils.SerializedModel` is uploaded as is.
         model_name: string
             A custom name for the Blazee model
         include_files: `list` of `str`
             The list of python files this model depends on, if the model depends on
             custom python code.
             Those dependencies will be packaged and distributed with the model.
+        quantize: `str`
+            Scikit Learn models only. Set to 'fp32' or 'fp16' to downcast the
+            fitted float arrays of the model, making it smaller to upload and
+            faster to load, at the cost of precision.
 
         Returns
         -------
@@ -96,10 +166,16 @@ class Client:
             The Blazee model that was deployed, ready to use for
             predictions
         """
-        serialized_model = _serialize_model(model, include_files=include_files)
+        serialized_model = _serialize_model(model,
+                                            include_files=include_files,
+                                            quantize=quantize)
 
         if not model_name:
-            model_name = f'{type(model).__name__} {datetime.now().isoformat()}'
+            if isinstance(model, SerializedModel):
+                model_type = model.type
+            else:
+                model_type = type(model).__name__
+            model_name = f'{model_type} {datetime.now().isoformat()}'
 
         model = self._create_model('sklearn', model_name=model_name)
         try:
@@ -120,26 +196,57 @@ class Client:
 
         return BlazeeModel(self, response)
 
-    def _api_call(self, path, method='GET', json=None):
-        if json is None:
+    def _predict_chunks(self, path, batches, max_in_flight, format='json'):
+        def predict_batch(batch):
+            return self._api_call(path, method='POST', json=batch, format=format)
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            resps = executor.map(predict_batch, batches)
+            return list(map(Prediction, itertools.chain.from_iterable(resps)))
+
+    def _api_call(self, path, method='GET', json=None, format='json', body=None):
+        # `body` is an already encoded request body, sent instead of `json`
+        if body is not None:
+            data = body
+        elif json is None:
             data = None
+        elif format == 'msgpack':
+            data = msgpack_dumps(json)
         else:
-            data = jsondumps(json, cls=NumpyEncoder)
-        resp = requests.request(method=method,
-                                url=f'{self.host}{path}',
-                                data=data,
-                                headers={
-                                    'X-Api-Key': self.api_key,
-                                    'Content-Type': 'application/json'
-                                })
-        if resp.status_code >= 500:
+            data = json_dumps(json)
+        url = f'{self.host}{path}'
+        headers = {
+            'X-Api-Key': self.api_key,
+            'Content-Type': CONTENT_TYPES[format]
+        }
+        if data is not None and len(data) > GZIP_MIN_SIZE:
+            data = gzip.compress(data, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        cached = self._etags.get(url) if method == 'GET' else None
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        resp = self._session.request(method=method,
+                                     url=url,
+                                     data=data,
+                                     headers=headers)
+        if resp.status_code == 304 and cached:
+            # Decode the body again, as callers may mutate what they get
+            self._etags.move_to_end(url)
+            return json_loads(cached[1])
+        elif resp.status_code >= 500:
             raise HTTPError(
                 f'{resp.status_code} Internal Server Error: Please contact us at support@blazee.io')
         elif resp.status_code == 403:
             raise HTTPError(
                 f'Invalid API Key. Get your API key on https://blazee.io')
         else:
-            body = resp.json()
+            try:
+                body = json_loads(resp.content)
+            except ValueError:
+                # e.g. an error page from a proxy
+                if resp.status_code >= 400:
+                    raise HTTPError(f'{resp.status_code} {resp.reason}')
+                raise
             if 'error' in body:
                 error = body['error']
                 error_msg = f"{resp.status_code} {body['error']['code']}: {body['error']['message']}"
@@ -148,4 +255,10 @@ class Client:
 
                 raise HTTPError(error_msg)
             else:
-                return resp.json()
+                etag = resp.headers.get('ETag')
+                if method == 'GET' and etag:
+                    self._etags[url] = (etag, resp.content)
+                    self._etags.move_to_end(url)
+                    if len(self._etags) > ETAG_CACHE_SIZE:
+                        self._etags.popitem(last=False)
+                return body
@@ -1,24 +1,18 @@
 import io
-import os
 
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee._optional import import_class
+from blazee.utils import (SerializedModel, add_file_deps, defined_in,
+                          get_model_metadata)
 
 
 def is_fastai(model):
-    try:
-        from fastai.basic_train import Learner
-        return isinstance(model, Learner)
-    except:
+    if not defined_in(type(model), 'fastai'):
         return False
+    return isinstance(model, import_class('fastai.basic_train', 'Learner'))
 
 
 def _get_model_metadata(model, include_files):
-    deps = ['fastai']
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
+    return get_model_metadata(['fastai'], include_files)
 
 
 def serialize_fastai(model, include_files):
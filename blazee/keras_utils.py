@@ -1,29 +1,22 @@
-import os
+import io
 
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee._optional import import_class
+from blazee.utils import (SerializedModel, add_file_deps, defined_in,
+                          get_model_metadata)
 
 
 def is_keras(model):
-    try:
-        from keras.models import Model
-        return isinstance(model, Model)
-    except:
+    if not defined_in(type(model), 'keras'):
         return False
+    return isinstance(model, import_class('keras.models', 'Model'))
 
 
 def serialize_keras(model, include_files):
-    # Unfortunately we cannot do that in memory yet, so use temp file
-    tmp_file = 'tmp.h5'
-    try:
-        model.save(tmp_file)
-        with open(tmp_file, 'rb') as f:
-            weights = f.read()
-    finally:
-        try:
-            os.remove(tmp_file)
-        except OSError:
-            pass
+    import h5py
+    buffer = io.BytesIO()
+    with h5py.File(buffer, 'w') as h5_file:
+        model.save(h5_file)
+    weights = buffer.getvalue()
 
     files = [('model.h5', weights)]
 
@@ -50,8 +43,4 @@ def get_keras_deps():
 
 
 def _get_model_metadata(model, include_files):
-    deps = get_keras_deps()
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
+    return get_model_metadata(get_keras_deps(), include_files)
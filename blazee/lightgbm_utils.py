@@ -1,37 +1,20 @@
-import io
-import os
-
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee._optional import import_class
+from blazee.utils import (SerializedModel, add_file_deps, defined_in,
+                          get_model_metadata)
 
 
 def is_lightgbm(model):
-    try:
-        from lightgbm.basic import Booster
-        return isinstance(model, Booster)
-    except:
+    if not defined_in(type(model), 'lightgbm'):
         return False
+    return isinstance(model, import_class('lightgbm.basic', 'Booster'))
 
 
 def _get_model_metadata(model, include_files):
-    deps = ['lightgbm']
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
+    return get_model_metadata(['lightgbm'], include_files)
 
 
 def serialize_lightgbm(model, include_files):
-    tmp_file = 'tmp.txt'
-    try:
-        model.save_model(tmp_file)
-        with open(tmp_file, 'rb') as f:
-            buffer = f.read()
-    finally:
-        try:
-            os.remove(tmp_file)
-        except OSError:
-            pass
+    buffer = model.model_to_string().encode('utf-8')
 
     files = [('model.txt', buffer)]
 
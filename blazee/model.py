@@ -19,11 +19,20 @@ Usage:
     # To deploy a new version of the model
     >>> model.update(new_model, default=False)
 """
+import hashlib
+import io
 import logging
+import queue
+import threading
 import time
+from concurrent.futures import Future
 
-import requests
-from dateutil import parser
+from requests.exceptions import HTTPError
+
+try:
+    from requests_toolbelt import MultipartEncoder
+except ImportError:
+    MultipartEncoder = None
 
 from blazee.fastai_utils import is_fastai, serialize_fastai
 from blazee.keras_utils import is_keras, serialize_keras
@@ -31,13 +40,21 @@ from blazee.lightgbm_utils import is_lightgbm, serialize_lightgbm
 from blazee.prediction import Prediction
 from blazee.pytorch_utils import is_pytorch, serialize_pytorch
 from blazee.sklearn_utils import is_sklearn, serialize_sklearn
-from blazee.utils import generate_zip, pretty_size
+from blazee.utils import (ARCHIVE_FORMATS, CONTENT_TYPES, UUID_PATTERN,
+                          SerializedModel, chunks, generate_archive, json_dumps,
+                          parse_datetime, pretty_size)
 from blazee.xgboost_utils import is_xgboost, serialize_xgboost
 
 
-def _serialize_model(model, include_files=None):
-    if is_sklearn(model):
-        return serialize_sklearn(model, include_files)
+def _serialize_model(model, include_files=None, quantize=None):
+    if quantize and not is_sklearn(model):
+        raise ValueError('Quantization is only supported for Scikit Learn models')
+
+    if isinstance(model, SerializedModel):
+        # Already serialized, e.g. to deploy the same model several times
+        return model
+    elif is_sklearn(model):
+        return serialize_sklearn(model, include_files, quantize=quantize)
     elif is_keras(model):
         return serialize_keras(model, include_files)
     elif is_pytorch(model):
@@ -52,6 +69,73 @@ def _serialize_model(model, include_files=None):
         raise TypeError(f'Model Type not supported: {type(model)}')
 
 
+def _upload_file(session, url, fields, content):
+    if MultipartEncoder is None:
+        return session.post(url, data=fields, files={'file': content})
+
+    # Stream the multipart body instead of building it in memory
+    encoder = MultipartEncoder(fields=[
+        *fields.items(),
+        ('file', ('model', content, 'application/octet-stream'))
+    ])
+    return session.post(url,
+                        data=encoder,
+                        headers={'Content-Type': encoder.content_type})
+
+
+# Fields of a full model resource, as returned by GET /models/{id}
+MODEL_FIELDS = {'id', 'name', 'default_version', 'created_at', 'updated_at'}
+
+# Predictions in flight, by host, API key, path and hash of the request body
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _predict(client, path, data, coalesce):
+    if not coalesce:
+        resp = client._api_call(path, method='POST', json=data)
+        return Prediction(resp)
+
+    # Requests are only shared between callers with the same credentials.
+    # The body is encoded once, for both the key and the request
+    body = json_dumps(data)
+    key = (client.host, client.api_key, path, hashlib.blake2b(body).digest())
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = _inflight[key] = Future()
+    if not is_leader:
+        return future.result()
+
+    try:
+        resp = client._api_call(path, method='POST', body=body)
+        prediction = Prediction(resp)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+    future.set_result(prediction)
+    return prediction
+
+
+def _predict_batch(client, path, data, chunk_size, max_concurrency, format):
+    if format not in CONTENT_TYPES:
+        raise ValueError(f'Unsupported format: {format}')
+    if not chunk_size or len(data) <= chunk_size:
+        resp = client._api_call(path, method='POST', json=data, format=format)
+        return list(map(Prediction, resp))
+
+    # Slicing keeps numpy arrays and DataFrames as such in each chunk
+    batches = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    return client._predict_chunks(path,
+                                  batches,
+                                  max_concurrency or client.max_in_flight,
+                                  format)
+
+
 class BlazeeModel:
     """BlazeeModel represents models that are deployed on Blazee.
     """
@@ -75,12 +159,12 @@ class BlazeeModel:
             The model
         """
         self._check_deleted()
-        self.client._api_call(f'/models/{self.id}',
-                              method='PATCH',
-                              json={
-                                  'name': name
-                              })
-        self._refresh()
+        resp = self.client._api_call(f'/models/{self.id}',
+                                     method='PATCH',
+                                     json={
+                                         'name': name
+                                     })
+        self._update_from(resp)
         return self
 
     def versions(self):
@@ -91,8 +175,9 @@ class BlazeeModel:
         versions: `list` of blazee.model.ModelVersion`
         """
         self._check_deleted()
-        resp = self.client._api_call(f'/models/{self.id}/versions')
-        return [ModelVersion(self.client, self, r) for r in resp]
+        if self._versions is None:
+            self._fetch_versions()
+        return list(self._versions)
 
     def get_version(self, name_or_id):
         """Returns the version of this model from its name or ID.
@@ -102,11 +187,23 @@ class BlazeeModel:
         model_version: `blazee.model.ModelVersion`
         """
         self._check_deleted()
-        for version in self.versions():
-            if name_or_id in [version.id, version.name]:
-                return version
-
-        raise ValueError(f"No version with ID or name {name_or_id}")
+        if self._versions is None and UUID_PATTERN.fullmatch(str(name_or_id)):
+            # Fetch this version only rather than listing all of them
+            try:
+                resp = self.client._api_call(
+                    f'/models/{self.id}/versions/{name_or_id}')
+                return ModelVersion(self.client, self, resp)
+            except HTTPError:
+                pass
+
+        if self._versions is None:
+            self._fetch_versions()
+        version = self._versions_by_id.get(name_or_id)
+        if version is None:
+            version = self._versions_by_name.get(name_or_id)
+        if version is None:
+            raise ValueError(f"No version with ID or name {name_or_id}")
+        return version
 
     def delete(self):
         """Deletes this model from Blazee"""
@@ -115,7 +212,7 @@ class BlazeeModel:
                               method='DELETE')
         self._deleted = True
 
-    def update(self, model, default=False, include_files=None):
+    def update(self, model, default=False, include_files=None, quantize=None):
         """Creates a new version of this model on Blazee and deploys it.
         Once this is finished, and if the deployment succeeds,
         the new version can be used for predictions.
@@ -125,13 +222,18 @@ class BlazeeModel:
         Parameters
         ----------
         model: one of `sklearn.base.BaseEstimator`, `keras.models.Model`, `torch.nn.Module`
-            The model to deploy
+            The model to deploy. An already serialized
+            `blazee.utils.SerializedModel` is uploaded as is.
         default: `bool`
             Whether or not the new model version should be set as default or not.
         include_files: `list` of `str`
             The list of python files this model depends on, if the model depends on
             custom python code.
             Those dependencies will be packaged and distributed with the model.
+        quantize: `str`
+            Scikit Learn models only. Set to 'fp32' or 'fp16' to downcast the
+            fitted float arrays of the model, making it smaller to upload and
+            faster to load, at the cost of precision.
 
         Returns
         -------
@@ -140,12 +242,14 @@ class BlazeeModel:
             predictions
         """
         self._check_deleted()
-        serialized_model = _serialize_model(model, include_files=include_files)
+        serialized_model = _serialize_model(model,
+                                            include_files=include_files,
+                                            quantize=quantize)
 
         version = self._upload_version(serialized_model)
         return version.model
 
-    def predict(self, data):
+    def predict(self, data, coalesce=False):
         """Gets a single prediction from the default version of this model.
 
         To make multiple predictions, see `batch_predict()`
@@ -157,6 +261,9 @@ class BlazeeModel:
             An array of features. This must be in the same format that what
             would be passed locally to the `predict()` method of the
             Scikit Learn model or pipeline.
+        coalesce: bool
+            Whether to share the response of an identical prediction
+            already in flight, instead of sending another request.
 
         Returns
         -------
@@ -164,12 +271,10 @@ class BlazeeModel:
             The prediction
         """
         self._check_deleted()
-        resp = self.client._api_call(f'/models/{self.id}/predict',
-                                     method='POST',
-                                     json=data)
-        return Prediction(resp)
+        return _predict(self.client, f'/models/{self.id}/predict', data, coalesce)
 
-    def predict_batch(self, data):
+    def predict_batch(self, data, chunk_size=None, max_concurrency=None,
+                      format='json'):
         """Gets a batch of predictions from the default version of this model.
 
 
@@ -183,6 +288,15 @@ class BlazeeModel:
             A list of list of features. This must be in the same format
             that what would be passed locally to the `predict()` method
             of the Scikit Learn model or pipeline.
+        chunk_size: int
+            If set, larger batches are split in chunks of this size,
+            sent concurrently.
+        max_concurrency: int
+            The maximum number of chunks sent concurrently. Defaults to
+            `client.max_in_flight`
+        format: string
+            The encoding of the request, 'json' or 'msgpack'. MessagePack
+            is more compact for floats and requires the `msgpack` package.
 
         Returns
         -------
@@ -190,11 +304,58 @@ class BlazeeModel:
             The predictions for the batch
         """
         self._check_deleted()
-        resp = self.client._api_call(f'/models/{self.id}/predict_batch',
-                                     method='POST',
-                                     json=data)
+        return _predict_batch(self.client,
+                              f'/models/{self.id}/predict_batch',
+                              data,
+                              chunk_size,
+                              max_concurrency,
+                              format)
+
+    def predict_many(self, data):
+        """Gets predictions for any number of samples from the default
+        version of this model.
+
+        The samples are sent in batches of `client.predict_batch_size`,
+        with up to `client.max_in_flight` concurrent requests.
+
+        Parameters
+        ----------
+
+        data: iterable of list
+            The samples to predict, in the same format as for `predict_batch()`
+
+        Returns
+        -------
+        predictions: list of `blazee.prediction.Prediction`
+            The predictions, in the same order as `data`
+        """
+        self._check_deleted()
+        batches = chunks(data, self.client.predict_batch_size)
+        return self.client._predict_chunks(f'/models/{self.id}/predict_batch',
+                                           batches,
+                                           self.client.max_in_flight)
 
-        return [Prediction(p) for p in resp]
+    def batched_predictor(self, max_batch_size=32, max_latency_ms=50):
+        """Returns a predictor coalescing concurrent single predictions
+        from the default version of this model into batch predictions.
+
+        Parameters
+        ----------
+
+        max_batch_size: int
+            The maximum number of samples sent in a single request
+        max_latency_ms: float
+            How long to wait for more samples before sending a batch
+
+        Returns
+        -------
+        predictor: `blazee.model.BatchingPredictor`
+            The predictor. Call `close()` once done, or use it as a context manager.
+        """
+        self._check_deleted()
+        return BatchingPredictor(self.predict_batch,
+                                 max_batch_size=max_batch_size,
+                                 max_latency_ms=max_latency_ms)
 
     def _reset(self, response):
         self.id = response['id']
@@ -205,13 +366,29 @@ class BlazeeModel:
                                                 response['default_version'])
         else:
             self.default_version = None
-        self.created_at = parser.parse(response['created_at'])
-        self.updated_at = parser.parse(response['updated_at'])
+        self.created_at = parse_datetime(response['created_at'])
+        self.updated_at = parse_datetime(response['updated_at'])
+        self._versions = None
+
+    def _fetch_versions(self):
+        resp = self.client._api_call(f'/models/{self.id}/versions')
+        self._versions = [ModelVersion(self.client, self, r) for r in resp]
+        self._versions_by_id = {v.id: v for v in self._versions}
+        self._versions_by_name = {}
+        for version in self._versions:
+            self._versions_by_name.setdefault(version.name, version)
 
     def _refresh(self):
         resp = self.client._api_call(f'/models/{self.id}')
         self._reset(resp)
 
+    def _update_from(self, resp):
+        # Mutating endpoints may return the updated model, saving a GET
+        if isinstance(resp, dict) and MODEL_FIELDS <= resp.keys():
+            self._reset(resp)
+        else:
+            self._refresh()
+
     def _check_deleted(self):
         if self._deleted:
             raise AssertionError('Model is deleted. Cannot perform operation')
@@ -223,46 +400,58 @@ class BlazeeModel:
         return f"<BlazeeModel '{self.name}'\n\tid={self.id}>"
 
     def _upload_version(self, serialized_model):
+        codec = self.client.codec
         resp = self.client._api_call(f'/models/{self.id}/versions',
                                      method="POST",
                                      json={
                                          'type': serialized_model.type,
-                                         'meta': serialized_model.metadata
+                                         'meta': {
+                                             **serialized_model.metadata,
+                                             'archive': ARCHIVE_FORMATS[codec]
+                                         }
                                      })
 
         upload_data = resp['upload_data']
-        content = generate_zip(serialized_model.files)
-        logging.info(
-            f'Uploading model version to Blazee  ({pretty_size(len(content))})...')
-        upload_resp = requests.post(upload_data['url'],
-                                    data=upload_data['fields'],
-                                    files={'file': content})
+        with generate_archive(serialized_model.files, codec,
+                              self.client.compresslevel) as content:
+            content.seek(0, io.SEEK_END)
+            size = content.tell()
+            content.seek(0)
+            logging.info(
+                f'Uploading model version to Blazee  ({pretty_size(size)})...')
+            upload_resp = _upload_file(self.client._session,
+                                       upload_data['url'],
+                                       upload_data['fields'],
+                                       content)
         upload_resp.raise_for_status()
 
-        version = ModelVersion(self.client, self, resp)
-        logging.info(f"Deploying new model version: {version.name}...")
+        logging.info(f"Deploying new model version: {resp['name']}...")
         self.client._api_call(
-            f'/models/{self.id}/versions/{version.id}/deploy',
+            f"/models/{self.id}/versions/{resp['id']}/deploy",
             method='PATCH')
-        version = self._wait_until_deployed(version)
+        version_resp = self._wait_until_deployed(resp)
+        version = ModelVersion(self.client, self, version_resp)
         logging.info(f"Successfully deployed model version {version.id}")
-        self._refresh()
+        self._update_from(version_resp.get('model'))
         return version
 
-    def _wait_until_deployed(self, version, sleep=10, max_retries=30):
-        left = max_retries
-        while left:
-            if version.deployed:
-                return version
-            if version.deployment_error:
+    def _wait_until_deployed(self, resp, sleep=0.5, max_sleep=10, timeout=300):
+        # Poll the version with exponential backoff, giving up after
+        # `timeout` seconds. Returns the last response, once deployed
+        version_id = resp['id']
+        deadline = time.monotonic() + timeout
+        while True:
+            if resp['deployed']:
+                return resp
+            if resp['deployment_error']:
                 raise RuntimeError(
                     "An error occurred while deploying the model")
+            if time.monotonic() + sleep > deadline:
+                raise TimeoutError("The model was not deployed")
             time.sleep(sleep)
+            sleep = min(sleep * 1.6, max_sleep)
             resp = self.client._api_call(
-                f'/models/{version.model.id}/versions/{version.id}')
-            version = ModelVersion(self.client, self, resp)
-            left -= 1
-        raise TimeoutError("The model was not deployed")
+                f"/models/{self.id}/versions/{version_id}")
 
 
 class ModelVersion:
@@ -278,8 +467,8 @@ class ModelVersion:
         self.meta = response['meta']
         self.deployed = response['deployed']
         self.deployment_error = response['deployment_error']
-        self.created_at = parser.parse(response['created_at'])
-        self.updated_at = parser.parse(response['updated_at'])
+        self.created_at = parse_datetime(response['created_at'])
+        self.updated_at = parse_datetime(response['updated_at'])
 
     def __repr__(self):
         return f"<ModelVersion '{self.model.name}' @ {self.name}\n\tid={self.id}\n\tdeployed={self.deployed}\n\tcreated_at={self.created_at}>"
@@ -287,7 +476,7 @@ class ModelVersion:
     def __str__(self):
         return f"<ModelVersion '{self.model.name}' @ {self.name}\n\tid={self.id}\n\tdeployed={self.deployed}\n\tcreated_at={self.created_at}>"
 
-    def predict(self, data):
+    def predict(self, data, coalesce=False):
         """Gets a single prediction from this model version
 
         To make multiple predictions, see `batch_predict()`
@@ -299,18 +488,22 @@ class ModelVersion:
             An array of features. This must be in the same format that what
             would be passed locally to the `predict()` method of the
             Scikit Learn model or pipeline.
+        coalesce: bool
+            Whether to share the response of an identical prediction
+            already in flight, instead of sending another request.
 
         Returns
         -------
         prediction: `blazee.prediction.Prediction`
             The prediction
         """
-        resp = self.client._api_call(f'/models/{self.model.id}/versions/{self.id}/predict',
-                                     method='POST',
-                                     json=data)
-        return Prediction(resp)
+        return _predict(self.client,
+                        f'/models/{self.model.id}/versions/{self.id}/predict',
+                        data,
+                        coalesce)
 
-    def predict_batch(self, data):
+    def predict_batch(self, data, chunk_size=None, max_concurrency=None,
+                      format='json'):
         """Gets a batch of predictions from this model version
 
         There is no size limit for the batch.
@@ -323,26 +516,175 @@ class ModelVersion:
             A list of list of features. This must be in the same format
             that what would be passed locally to the `predict()` method
             of the Scikit Learn model or pipeline.
+        chunk_size: int
+            If set, larger batches are split in chunks of this size,
+            sent concurrently.
+        max_concurrency: int
+            The maximum number of chunks sent concurrently. Defaults to
+            `client.max_in_flight`
+        format: string
+            The encoding of the request, 'json' or 'msgpack'. MessagePack
+            is more compact for floats and requires the `msgpack` package.
 
         Returns
         -------
         predictions: list of `blazee.prediction.Prediction`
             The predictions for the batch
         """
-        resp = self.client._api_call(f'/models/{self.model.id}/versions/{self.id}/predict_batch',
-                                     method='POST',
-                                     json=data)
+        return _predict_batch(self.client,
+                              f'/models/{self.model.id}/versions/{self.id}/predict_batch',
+                              data,
+                              chunk_size,
+                              max_concurrency,
+                              format)
+
+    def predict_many(self, data):
+        """Gets predictions for any number of samples from this model version
+
+        The samples are sent in batches of `client.predict_batch_size`,
+        with up to `client.max_in_flight` concurrent requests.
+
+        Parameters
+        ----------
+
+        data: iterable of list
+            The samples to predict, in the same format as for `predict_batch()`
+
+        Returns
+        -------
+        predictions: list of `blazee.prediction.Prediction`
+            The predictions, in the same order as `data`
+        """
+        batches = chunks(data, self.client.predict_batch_size)
+        return self.client._predict_chunks(f'/models/{self.model.id}/versions/{self.id}/predict_batch',
+                                           batches,
+                                           self.client.max_in_flight)
 
-        return [Prediction(p) for p in resp]
+    def batched_predictor(self, max_batch_size=32, max_latency_ms=50):
+        """Returns a predictor coalescing concurrent single predictions
+        from this model version into batch predictions.
+
+        Parameters
+        ----------
+
+        max_batch_size: int
+            The maximum number of samples sent in a single request
+        max_latency_ms: float
+            How long to wait for more samples before sending a batch
+
+        Returns
+        -------
+        predictor: `blazee.model.BatchingPredictor`
+            The predictor. Call `close()` once done, or use it as a context manager.
+        """
+        return BatchingPredictor(self.predict_batch,
+                                 max_batch_size=max_batch_size,
+                                 max_latency_ms=max_latency_ms)
 
     def make_default(self):
         """Makes this version the default version of the model.
         Once this version is the default, it will be used to compute
         predictions for this model.
         """
-        self.client._api_call(f'/models/{self.model.id}',
-                              method='PATCH',
-                              json={
-                                  'default_version_id': self.id
-                              })
-        self.model._refresh()
+        resp = self.client._api_call(f'/models/{self.model.id}',
+                                     method='PATCH',
+                                     json={
+                                         'default_version_id': self.id
+                                     })
+        self.model._update_from(resp)
+
+
+class BatchingPredictor:
+    """BatchingPredictor groups single predictions made concurrently, e.g. from
+    several threads of a web server, into calls to `predict_batch()`.
+
+    A batch is sent once it holds `max_batch_size` samples, or
+    `max_latency_ms` after its first sample was queued.
+
+    Usage:
+
+        >>> with model.batched_predictor() as predictor:
+        ...     pred = predictor.predict(X[0])
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_latency_ms=50):
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+        self._predict_batch = predict_batch
+        self._queue = queue.Queue()
+        # Guards _closed, so that nothing is queued after the stop marker
+        self._lock = threading.Lock()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def predict(self, data):
+        """Gets a single prediction, sent as part of a batch.
+
+        Parameters
+        ----------
+
+        data: list
+            An array of features, in the same format as for `BlazeeModel.predict()`
+
+        Returns
+        -------
+        prediction: `blazee.prediction.Prediction`
+            The prediction
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise AssertionError('Predictor is closed. Cannot perform operation')
+            self._queue.put((data, future))
+        return future.result()
+
+    def close(self):
+        """Sends the pending predictions and stops the predictor"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_latency_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._send(batch)
+                    return
+                batch.append(item)
+            self._send(batch)
+
+    def _send(self, batch):
+        try:
+            predictions = self._predict_batch([data for data, _ in batch])
+            if len(predictions) != len(batch):
+                # Predictions cannot be matched to their samples
+                raise ValueError(f'Expected {len(batch)} predictions, '
+                                 f'got {len(predictions)}')
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
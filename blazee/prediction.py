@@ -27,12 +27,11 @@ class Prediction:
         For a regression problem, this will be `None`
     """
 
+    __slots__ = ('prediction', 'probas')
+
     def __init__(self, resp):
         self.prediction = resp['prediction']
-        try:
-            self.probas = resp['probas']
-        except KeyError:
-            self.probas = None
+        self.probas = resp.get('probas')
 
     def __repr__(self):
         return f"<Prediction\n\tprediction={self.prediction}\n\tprobas={self.probas}>"
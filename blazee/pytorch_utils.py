@@ -1,41 +1,76 @@
-import io
+import pickle
+import tempfile
 
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee._optional import import_class
+from blazee.utils import (SPOOL_MAX_SIZE, SerializedModel, add_file_deps,
+                          defined_in, get_model_metadata)
 
 
 def is_pytorch(model):
-    try:
-        from torch.nn import Module
-        return isinstance(model, Module)
-    except:
+    if not defined_in(type(model), 'torch'):
         return False
+    return isinstance(model, import_class('torch.nn', 'Module'))
 
 
 def _get_model_metadata(model, include_files):
     deps = ['torch', 'numpy']  # For some reason numpy is not a torch dep
-    if include_files:
-        deps += get_files_dependencies(include_files)
+    return get_model_metadata(deps, include_files)
 
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
 
+# Serialized file name for each serialization mode
+PYTORCH_MODES = {
+    'pickle': 'model.pickle',
+    'state_dict': 'state_dict.pt',
+    'torchscript': 'model.pt',
+}
 
-def serialize_pytorch(model, include_files):
-    import torch
-    buffer = io.BytesIO()
-    torch.save(model, buffer)
 
-    files = [('model.pickle', buffer.getvalue())]
+def serialize_pytorch(model, include_files, mode='pickle'):
+    """Serializes a PyTorch model, to be passed to `Blazee.deploy_model()`
+    or `BlazeeModel.update()`.
+
+    Parameters
+    ----------
+    model: `torch.nn.Module`
+        The model to serialize
+    include_files: `list` of `str`
+        The list of python files this model depends on
+    mode: string
+        'pickle' pickles the whole module. 'state_dict' only saves the
+        weights, the model class being instantiated with no arguments on Blazee.
+        Both require the file defining the model class in `include_files`.
+        'torchscript' saves a TorchScript program, which does not depend
+        on your code.
 
-    if not include_files:
+    Returns
+    -------
+    serialized_model: `blazee.utils.SerializedModel`
+    """
+    import torch
+    if mode not in PYTORCH_MODES:
+        raise ValueError(f'Unsupported PyTorch serialization mode: {mode}')
+    if mode != 'torchscript' and not include_files:
         raise ValueError(
             "With PyTorch, you must include the file where your model is defined (class extending torch.nn.Module)")
 
+    # Spool large models to disk rather than keeping a copy in memory
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    if mode == 'torchscript':
+        torch.jit.save(torch.jit.script(model), buffer)
+    elif mode == 'state_dict':
+        torch.save(model.state_dict(), buffer,
+                   pickle_protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        torch.save(model, buffer, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+
+    files = [(PYTORCH_MODES[mode], buffer)]
+
     add_file_deps(files, include_files)
 
     meta = _get_model_metadata(model, include_files)
+    meta['format'] = mode
+    if mode == 'state_dict':
+        model_class = type(model)
+        meta['model_class'] = f'{model_class.__module__}.{model_class.__qualname__}'
 
     return SerializedModel('pytorch', meta, files)
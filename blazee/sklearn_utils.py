@@ -1,57 +1,50 @@
+import copy
 import pickle
 
+from blazee._optional import has_module, import_class
 from blazee.keras_utils import get_keras_deps
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee.utils import (SerializedModel, add_file_deps, defined_in,
+                          get_model_metadata)
+
+
+# Estimator libraries requiring extra dependencies, with the
+# module and name of their base estimator class
+ESTIMATOR_LIBRARIES = (
+    ('keras', 'keras.wrappers.scikit_learn', 'BaseWrapper'),
+    ('xgboost', 'xgboost.sklearn', 'XGBModel'),
+    ('lightgbm', 'lightgbm.sklearn', 'LGBMModel'),
+)
 
 
 def is_sklearn(model):
-    try:
-        from sklearn.base import BaseEstimator
-        if isinstance(model, BaseEstimator):
+    model_type = type(model)
+    if defined_in(model_type, 'sklearn'):
+        if isinstance(model, import_class('sklearn.base', 'BaseEstimator')):
             return True
-    except:
-        pass
 
     # Check for Keras SK Wrapper
-    try:
-        from keras.wrappers.scikit_learn import BaseWrapper
-        if isinstance(model, BaseWrapper):
+    if defined_in(model_type, 'keras'):
+        if isinstance(model, import_class('keras.wrappers.scikit_learn',
+                                          'BaseWrapper')):
             return True
-    except:
-        pass
 
     return False
 
 
 def _get_estimator_dependencies(estimator):
-    # Keras
-    try:
-        from keras.wrappers.scikit_learn import BaseWrapper
-        if isinstance(estimator, BaseWrapper):
-            return get_keras_deps()
-    except:
-        pass
-    # XGBoost
-    try:
-        from xgboost.sklearn import XGBClassifier
-        if isinstance(estimator, XGBClassifier):
-            return ['xgboost']
-    except:
-        pass
-    # LightGBM
-    try:
-        from lightgbm.sklearn import LGBMModel
-        if isinstance(estimator, LGBMModel):
-            return ['lightgbm']
-    except:
-        pass
-
-    return []
+    estimator_type = type(estimator)
+    for package, module, class_name in ESTIMATOR_LIBRARIES:
+        # Only estimators defined in the library can be instances of its
+        # classes, which avoids importing unused libraries
+        if defined_in(estimator_type, package) and \
+                isinstance(estimator, import_class(module, class_name)):
+            return get_keras_deps() if package == 'keras' else (package,)
+
+    return ()
 
 
 def _get_model_metadata(model, include_files):
-    deps = ['scikit-learn']
+    deps = {'scikit-learn'}
     from sklearn.pipeline import Pipeline
     from sklearn.base import BaseEstimator
     from sklearn.model_selection._search import BaseSearchCV
@@ -59,35 +52,192 @@ def _get_model_metadata(model, include_files):
     # Import other depdendencies if needed
     if isinstance(model, Pipeline):
         for _, estimator in model.steps:
-            deps += _get_estimator_dependencies(estimator)
+            deps.update(_get_estimator_dependencies(estimator))
     elif isinstance(model, BaseSearchCV):
-        deps += _get_estimator_dependencies(model.estimator)
+        deps.update(_get_estimator_dependencies(model.estimator))
     elif isinstance(model, BaseEstimator):
-        deps += _get_estimator_dependencies(model)
+        deps.update(_get_estimator_dependencies(model))
     else:
         raise ValueError(f"Model of type {type(model)} not supported")
 
-    if include_files:
-        deps += get_files_dependencies(include_files)
+    return get_model_metadata(deps, include_files)
+
+
+def _has_fitted_state(estimator):
+    """Returns whether `estimator` can be checked with `check_is_fitted()`.
+    Estimators of sklearn follow its fitted attributes convention, and
+    declare stateless ones through their tags. Custom estimators can be
+    stateless without saying so, and are only checked when they expose
+    fitted attributes."""
+    if type(estimator).__module__.split('.')[0] == 'sklearn':
+        return True
+    return hasattr(estimator, '__sklearn_is_fitted__') or any(
+        name.endswith('_') and not name.startswith('__')
+        for name in getattr(estimator, '__dict__', ()))
 
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
 
+def _check_is_fitted(model):
+    from sklearn.base import BaseEstimator
+    from sklearn.exceptions import NotFittedError
+    from sklearn.model_selection._search import BaseSearchCV
+    from sklearn.pipeline import Pipeline
+    from sklearn.utils.validation import check_is_fitted
 
-def serialize_sklearn(model, include_files):
-    # Check if model is fitted
-    try:
-        model.predict([0])
-    except Exception as e:
-        from sklearn.exceptions import NotFittedError
-        if isinstance(e, NotFittedError):
+    if isinstance(model, Pipeline):
+        for _, estimator in model.steps:
+            _check_is_fitted(estimator)
+    elif isinstance(model, BaseSearchCV):
+        # Searches predict with their best estimator, which is only
+        # available once fitted with refit=True
+        if not hasattr(model, 'best_estimator_'):
+            raise AttributeError("This model hasn't been trained yet")
+        _check_is_fitted(model.best_estimator_)
+    elif isinstance(model, BaseEstimator) and _has_fitted_state(model):
+        # Keras SK wrappers and stateless custom estimators do not follow the
+        # fitted attributes convention, and pipeline steps can be 'passthrough'
+        try:
+            check_is_fitted(model)
+        except NotFittedError:
             raise AttributeError("This model hasn't been trained yet")
 
-    content = pickle.dumps(model)
-    files = [('model.pickle', content)]
+
+# Target dtype of each quantization mode
+QUANTIZE_DTYPES = {
+    'fp32': 'float32',
+    'fp16': 'float16',
+}
+
+# Fitted weight attributes that are downcast. Other fitted arrays, such as
+# classes_ or thresholds, must keep their exact values
+QUANTIZE_ATTRIBUTES = frozenset([
+    'coef_',
+    'intercept_',
+    'components_',
+    'cluster_centers_',
+    'means_',
+    'covariances_',
+    'precisions_',
+    'precisions_cholesky_',
+    'coefs_',
+    'intercepts_',
+    'dual_coef_',
+    'support_vectors_',
+    'mean_',
+    'var_',
+    'scale_',
+    'theta_',
+    'feature_log_prob_',
+])
+
+
+def _iter_estimators(model):
+    from sklearn.base import BaseEstimator
+    from sklearn.pipeline import Pipeline
+    from sklearn.model_selection._search import BaseSearchCV
+
+    if isinstance(model, BaseEstimator):
+        yield model
+    if isinstance(model, Pipeline):
+        for _, estimator in model.steps:
+            yield from _iter_estimators(estimator)
+    elif isinstance(model, BaseSearchCV) and hasattr(model, 'best_estimator_'):
+        yield from _iter_estimators(model.best_estimator_)
+
+
+def _downcast(value, dtype):
+    import numpy as np
+
+    if (isinstance(value, np.ndarray) and value.dtype.kind == 'f'
+            and value.dtype.itemsize > dtype.itemsize):
+        return value.astype(dtype)
+    return value
+
+
+def _quantize(model, quantize):
+    import numpy as np
+    from sklearn.ensemble import BaseEnsemble
+    from sklearn.tree import BaseDecisionTree
+
+    if quantize not in QUANTIZE_DTYPES:
+        raise ValueError(f'Unsupported quantization: {quantize}')
+    dtype = np.dtype(QUANTIZE_DTYPES[quantize])
+
+    model = copy.deepcopy(model)
+    for estimator in _iter_estimators(model):
+        # Trees are cast back to float64 when unpickled
+        if isinstance(estimator, (BaseDecisionTree, BaseEnsemble)):
+            continue
+        for name, value in vars(estimator).items():
+            if name not in QUANTIZE_ATTRIBUTES:
+                continue
+            if isinstance(value, list):
+                # e.g. the layers of MLPs
+                setattr(estimator, name, [_downcast(v, dtype) for v in value])
+            else:
+                setattr(estimator, name, _downcast(value, dtype))
+    return model
+
+
+SERIALIZATION_FORMATS = ('joblib', 'pickle')
+
+
+def serialize_sklearn(model, include_files, quantize=None, format=None):
+    """Serializes a Scikit Learn model, to be passed to `Blazee.deploy_model()`
+    or `BlazeeModel.update()`.
+
+    Parameters
+    ----------
+    model: `sklearn.base.BaseEstimator`
+        The fitted model or pipeline to serialize
+    include_files: `list` of `str`
+        The list of python files this model depends on
+    quantize: string
+        See `Blazee.deploy_model()`
+    format: string
+        'joblib' dumps the model to a single uncompressed joblib file,
+        which is compressed with the rest of the upload archive.
+        'pickle' stores each numpy buffer as its own archive entry next to
+        a small pickle stream, rather than copying them into the stream.
+        Defaults to 'joblib' when it is installed.
+
+    Returns
+    -------
+    serialized_model: `blazee.utils.SerializedModel`
+    """
+    _check_is_fitted(model)
+    if format is not None and format not in SERIALIZATION_FORMATS:
+        raise ValueError(f'Unsupported serialization format: {format}')
+    if quantize:
+        # Downcast fitted float arrays of a copy of the model. This is lossy
+        model = _quantize(model, quantize)
+
+    if format is None:
+        format = 'joblib' if has_module('joblib') else 'pickle'
+
+    if format == 'joblib':
+        import joblib
+
+        # joblib writes numpy buffers directly. The dump is streamed into
+        # the archive when it is generated, and only compressed there
+        def dump(fh):
+            joblib.dump(model, fh, compress=0,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        files = [('model.joblib', dump)]
+    else:
+        # Keep numpy buffers out-of-band rather than copying them into the
+        # pickle stream. They are loaded back with pickle.loads(buffers=...)
+        buffers = []
+        content = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL,
+                               buffer_callback=buffers.append)
+        files = [('model.pickle', content)]
+        files += [(f'buffers/{i}.bin', buffer.raw())
+                  for i, buffer in enumerate(buffers)]
 
     add_file_deps(files, include_files)
     meta = _get_model_metadata(model, include_files)
+    meta['format'] = format
+    if format == 'pickle':
+        meta['pickle_buffers'] = len(buffers)
+    if quantize:
+        meta['quantize'] = quantize
     return SerializedModel('sklearn', meta, files)
@@ -1,123 +1,480 @@
+import ast
+import functools
 import io
+import itertools
 import json
 import logging
+import math
+import os
 import re
+import shutil
+import sys
+import sysconfig
+import tarfile
+import tempfile
 import zipfile
+import zlib
 from collections import namedtuple
+from datetime import datetime
+from importlib import metadata
 
-import numpy as np
-import pkg_resources
+from blazee._optional import has_module
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 SerializedModel = namedtuple('SerializedModel', ('type', 'metadata', 'files'))
 
+UUID_PATTERN = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z', re.I)
+
+# Name of a package in a requirement string, e.g. 'numpy>=1.17'
+REQUIREMENT_NAME = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+EXTRA_MARKER = re.compile(r'\bextra\s*==')
+
+# Content type of request bodies, by encoding format
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+}
+
 
 class NumpyEncoder(json.JSONEncoder):
     def default(self, obj):
-        obj_type = type(obj)
-        name = f'{obj_type.__module__}.{obj_type.__name__}'
-        if name in ['numpy.ndarray', 'pandas.core.series.Series', 'pytorch.Tensor']:
+        # Objects of a library can only exist once it is imported
+        np = sys.modules.get('numpy')
+        if np is not None and isinstance(obj, (np.ndarray, np.generic)):
+            # Also converts every numpy scalar type to int, float or bool
+            return obj.tolist()
+        elif hasattr(obj, 'to_numpy'):
+            # pandas DataFrame and Series
+            return obj.to_numpy().tolist()
+        torch = sys.modules.get('torch')
+        if torch is not None and isinstance(obj, torch.Tensor):
             return obj.tolist()
-        elif name == 'pandas.core.frame.DataFrame':
-            return np.array(obj).tolist()
-        elif name == 'numpy.int64':
-            return int(obj)
-        elif name == 'numpy.float64':
-            return float(obj)
 
         return json.JSONEncoder.default(self, obj)
 
 
+_numpy_encoder = NumpyEncoder()
+
+
+def _orjson_default(obj):
+    if hasattr(obj, 'to_numpy'):
+        # pandas objects: let orjson serialize the underlying array natively
+        return obj.to_numpy()
+    return _numpy_encoder.default(obj)
+
+
+def _has_non_finite(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    elif isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    np = sys.modules.get('numpy')
+    if np is None:
+        return False
+    if hasattr(obj, 'to_numpy'):
+        obj = obj.to_numpy()
+    if isinstance(obj, (np.ndarray, np.generic)):
+        if obj.dtype.kind in 'fc':
+            return not np.isfinite(obj).all()
+        elif obj.dtype.kind == 'O':
+            return any(_has_non_finite(value) for value in obj.ravel())
+    return False
+
+
+def json_dumps(obj):
+    """Encodes `obj` to JSON bytes, with support for numpy and pandas objects.
+    NaN and infinities are encoded as `NaN` and `Infinity`, like the json
+    module does"""
+    if orjson:
+        content = orjson.dumps(obj,
+                               default=_orjson_default,
+                               option=orjson.OPT_SERIALIZE_NUMPY |
+                               orjson.OPT_NON_STR_KEYS)
+        # orjson encodes non-finite floats as null, so only scan the payload
+        # for them when it has nulls
+        if b'null' not in content or not _has_non_finite(obj):
+            return content
+    # If numpy was never imported, obj cannot contain numpy values
+    np = sys.modules.get('numpy')
+    if np is not None:
+        obj = _to_builtin(obj, (np.ndarray, np.generic))
+    return json.dumps(obj, cls=NumpyEncoder).encode()
+
+
+def msgpack_dumps(obj):
+    """Encodes `obj` to MessagePack bytes, with support for numpy and pandas
+    objects. Requires the `msgpack` package"""
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError(
+            "The msgpack format requires the msgpack package: pip install msgpack")
+    np = sys.modules.get('numpy')
+    if np is not None:
+        obj = _to_builtin(obj, (np.ndarray, np.generic))
+    return msgpack.packb(obj, default=_numpy_encoder.default, use_bin_type=True)
+
+
+def json_loads(content):
+    """Decodes JSON bytes, including `NaN` and `Infinity` values"""
+    if orjson:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN and Infinity tokens the json module emits
+            pass
+    return json.loads(content)
+
+
+def parse_datetime(value):
+    """Parses an ISO-8601 timestamp returned by the API"""
+    try:
+        # Implemented in C, much faster than dateutil
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        from dateutil.parser import isoparse
+        return isoparse(value)
+
+
+def _to_builtin(obj, numpy_types):
+    # Convert numpy arrays in one tolist() call each, rather than
+    # one NumpyEncoder.default() call per element
+    if isinstance(obj, dict):
+        return {key: _to_builtin(value, numpy_types)
+                for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_to_builtin(value, numpy_types) for value in obj]
+    elif isinstance(obj, numpy_types):
+        return obj.tolist()
+    return obj
+
+
+@functools.lru_cache(maxsize=None)
+def defined_in(cls, *packages):
+    """Returns whether `cls` or one of its base classes is defined in one
+    of the given top-level packages, without importing them"""
+    return any(base.__module__.split('.')[0] in packages for base in cls.__mro__)
+
+
+def chunks(iterable, size):
+    """Yields lists of at most `size` consecutive items of `iterable`"""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+
 def pretty_size(num_bytes):
-    if num_bytes < 1024:
+    # Each unit is 10 more bits
+    unit = min((num_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    if unit <= 0:
         return f'{num_bytes} B'
-    elif num_bytes < 1024 * 1024:
-        return f'{num_bytes / 1024:.1f} KB'
-    else:
-        return f'{num_bytes / 1024 / 1024:.1f} MB'
+    return f'{num_bytes / (1 << unit * 10):.1f} {SIZE_UNITS[unit]}'
+
+
+# Archives larger than this are spooled to disk instead of being kept in memory
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Size of the chunks copied into archive entries
+COPY_BUFFER_SIZE = 1 << 20
+
+# Zip entries are stored uncompressed when compressing their first
+# COMPRESSION_PROBE_SIZE bytes saves less than 3%, e.g. float arrays
+COMPRESSION_PROBE_SIZE = 64 * 1024
+MIN_COMPRESSION_RATIO = 0.97
+
+# Archive format produced by each compression codec
+ARCHIVE_FORMATS = {
+    'zstd': 'tar.zst',
+    'lz4': 'tar.lz4',
+    'deflate': 'zip',
+    'lzma': 'zip',
+}
 
 
-def generate_zip(files):
-    zipped = io.BytesIO()
+def default_codec():
+    """Returns the fastest compression codec available"""
+    if has_module('zstandard'):
+        return 'zstd'
+    return 'deflate'
 
-    with zipfile.ZipFile(zipped, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+
+def generate_archive(files, codec='deflate', compresslevel=None):
+    """Packs `files` into an archive compressed with `codec`, and returns
+    it as a file object positioned at its start.
+    See `ARCHIVE_FORMATS` for the supported codecs. `compresslevel`
+    defaults to a fast level for each codec, and cannot be set for lzma."""
+    if codec == 'deflate':
+        level = 3 if compresslevel is None else compresslevel
+        return generate_zip(files, compresslevel=level)
+    elif codec == 'lzma':
+        if compresslevel is not None:
+            raise ValueError('The lzma codec does not support compresslevel')
+        return generate_zip(files, compression=zipfile.ZIP_LZMA)
+    elif codec in ARCHIVE_FORMATS:
+        return generate_tar(files, codec, compresslevel=compresslevel)
+    raise ValueError(f'Unsupported compression codec: {codec}')
+
+
+def generate_zip(files, compression=zipfile.ZIP_DEFLATED, compresslevel=3):
+    """Zips `files` into a file object positioned at its start.
+    File contents can be bytes, binary file objects, or callables writing
+    the content to the file object they are given.
+
+    The default deflate level 3 is several times faster than zlib's
+    default level 6 on pickles, for slightly larger archives."""
+    zipped = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    with zipfile.ZipFile(zipped, mode="w") as zf:
         for file_name, content in files:
             zinfo = zipfile.ZipInfo(file_name)
             zinfo.external_attr = 0o644 << 16  # give read access
-            zf.writestr(zinfo, content)
+            if _is_compressible(content):
+                zinfo.compress_type = compression
+                # ZipInfo has no public setter for it before Python 3.13
+                zinfo._compresslevel = compresslevel
+            if callable(content):
+                # Written straight into the compressed entry. Buffering
+                # groups the many small writes of picklers
+                with zf.open(zinfo, mode='w', force_zip64=True) as dest, \
+                        io.BufferedWriter(dest, COPY_BUFFER_SIZE) as buffered:
+                    content(buffered)
+            elif hasattr(content, 'read'):
+                content.seek(0)
+                with zf.open(zinfo, mode='w', force_zip64=True) as dest:
+                    shutil.copyfileobj(content, dest, COPY_BUFFER_SIZE)
+            else:
+                zf.writestr(zinfo, content)
+
+    zipped.seek(0)
+    return zipped
+
+
+def _is_compressible(content):
+    """Returns whether compressing a sample of `content` saves enough space
+    to be worth it. Writers cannot be sampled and are assumed compressible"""
+    if callable(content):
+        return True
+    if hasattr(content, 'read'):
+        content.seek(0)
+        sample = content.read(COMPRESSION_PROBE_SIZE)
+    else:
+        sample = content[:COMPRESSION_PROBE_SIZE]
+    if not sample:
+        return True
+    return len(zlib.compress(sample, 1)) < len(sample) * MIN_COMPRESSION_RATIO
 
-    return zipped.getvalue()
+
+def generate_tar(files, codec, compresslevel=None):
+    """Tars `files` into a stream compressed with `codec` ('zstd' or 'lz4'),
+    and returns it as a file object positioned at its start.
+    File contents can be bytes, binary file objects, or callables writing
+    the content to the file object they are given."""
+    archive = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    if codec == 'zstd':
+        import zstandard
+        level = 3 if compresslevel is None else compresslevel
+        # threads=-1 compresses on as many threads as there are CPU cores
+        compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+        compressor = compressor.stream_writer(archive, closefd=False)
+    else:
+        import lz4.frame
+        level = 0 if compresslevel is None else compresslevel
+        compressor = lz4.frame.open(archive, mode='wb', compression_level=level)
+
+    with compressor, tarfile.open(fileobj=compressor, mode='w|') as tar:
+        for file_name, content in files:
+            tarinfo = tarfile.TarInfo(file_name)
+            tarinfo.mode = 0o644  # give read access
+            if callable(content):
+                # Tar headers need the size first, so spool the content
+                writer = content
+                content = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                writer(content)
+            if hasattr(content, 'read'):
+                content.seek(0, io.SEEK_END)
+                tarinfo.size = content.tell()
+                content.seek(0)
+            else:
+                tarinfo.size = len(content)
+                content = io.BytesIO(content)
+            tar.addfile(tarinfo, content)
+
+    archive.seek(0)
+    return archive
+
+
+def get_model_metadata(packages, include_files=None):
+    """Returns the metadata of a model depending on the given packages
+    and python files"""
+    if include_files:
+        packages = {*packages, *get_files_dependencies(include_files)}
+    return {
+        'lib_versions': get_requirements(packages),
+        'include_files': include_files
+    }
 
 
 def get_requirements(packages):
+    return dict(_get_requirements(tuple(sorted(set(packages)))))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_requirements(packages):
     deps = {}
     for pkg in packages:
-        preqs = get_installed_versions(pkg)
-        deps = {**deps, **preqs}
+        deps.update(get_installed_versions(pkg))
     return deps
 
 
-def get_installed_versions(package, skip=None):
-    skip = skip or []
-    if package in skip:
-        return {}
-    skip.append(package)
-    dist = pkg_resources.get_distribution(package)
-    requirements = {package: dist.version}
-    for require in dist.requires():
-        dep = require.name
-        dep_reqs = get_installed_versions(dep, skip=skip)
-        requirements = {**requirements, **dep_reqs}
+def get_installed_versions(package):
+    """Returns the installed versions of `package` and of its transitive
+    dependencies, by package name"""
+    requirements = {}
+    stack = [package]
+    while stack:
+        pkg = stack.pop()
+        if pkg in requirements:
+            continue
+        dist = _get_distribution(pkg)
+        if dist is None:
+            if pkg == package:
+                raise metadata.PackageNotFoundError(package)
+            # e.g. a dependency restricted to other platforms
+            continue
+        version, requires = dist
+        requirements[pkg] = version
+        # Dependencies of extras are not installed with the package
+        stack.extend(REQUIREMENT_NAME.match(require).group(0)
+                     for require in requires
+                     if not EXTRA_MARKER.search(require))
     return requirements
 
 
 def get_files_dependencies(file_names):
+    # Modification times are part of the cache key so edited files are rescanned
+    files = tuple((f, os.path.getmtime(f)) for f in file_names)
+    return list(_get_files_dependencies(files))
+
+
+@functools.lru_cache(maxsize=32)
+def _get_files_dependencies(files):
     deps = set([])
-    for file_name in file_names:
+    for file_name, _ in files:
         deps |= get_file_dependencies(file_name)
-    return list(deps)
+    return frozenset(deps)
 
 
 def get_file_dependencies(file_name):
-    import_pattern = re.compile(r'import (.+)')
-    from_pattern = re.compile(r'from (.+) import (.+)')
+    # Include files can also be data files, e.g. vocabularies
+    if not file_name.endswith('.py'):
+        return set([])
+    with open(file_name, 'rb') as f:
+        try:
+            tree = ast.parse(f.read(), filename=file_name)
+        except (SyntaxError, ValueError):
+            logging.warning(f'Could not parse {file_name}, skipping its imports')
+            return set([])
     reqs = set([])
-    with open(file_name, 'r') as f:
-        for l in f.readlines():
-            imp_match = import_pattern.match(l)
-            from_match = from_pattern.match(l)
-            if imp_match:
-                imp = imp_match[1]
-                req = parse_import(imp)
-                if req:
-                    reqs.add(req)
-            elif from_match:
-                imp = from_match[1]
-                req = parse_import(imp)
-                if req:
-                    reqs.add(req)
+    for node in _iter_statements(tree.body):
+        if isinstance(node, ast.Import):
+            imports = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            imports = [node.module]
+        else:
+            # Relative imports are resolved by include_files
+            continue
+        for imp in imports:
+            req = parse_import(imp)
+            if req:
+                reqs.add(req)
     return reqs
 
 
+def _iter_statements(statements):
+    # Imports are statements, so only statement bodies are visited rather
+    # than every expression node, as ast.walk() would
+    for node in statements:
+        yield node
+        for field in ('body', 'orelse', 'finalbody', 'handlers', 'cases'):
+            children = getattr(node, field, None)
+            if isinstance(children, list):
+                yield from _iter_statements(children)
+
+
 def parse_import(imp):
     if imp.startswith('.'):
         # Relative import
         # TODO: Check it's included in include_files
         return None
-    try:
-        pkg_name = imp.split('.')[0]
-        pkg_resources.get_distribution(pkg_name)
-        return pkg_name
-    except pkg_resources.DistributionNotFound:
+    pkg_name = imp.split('.')[0]
+    if pkg_name in _stdlib_modules():
+        return None
+    if _get_distribution(pkg_name) is None:
         # Relative import
         # TODO: Check it's included in include_files
         return None
+    return pkg_name
+
+
+@functools.lru_cache(maxsize=None)
+def _stdlib_modules():
+    """Returns the names of the standard library modules, which are never
+    installed as distributions"""
+    modules = set(sys.builtin_module_names)
+    if hasattr(sys, 'stdlib_module_names'):
+        return frozenset(modules | sys.stdlib_module_names)
+
+    # Before Python 3.10, list the standard library directories
+    paths = sysconfig.get_paths()
+    for directory in (paths['stdlib'],
+                      os.path.join(paths['platstdlib'], 'lib-dynload')):
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            continue
+        for entry in entries:
+            name = entry.split('.')[0]
+            if name.isidentifier():
+                modules.add(name)
+    return frozenset(modules)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_distribution(name):
+    """Returns the version and requirements of an installed distribution,
+    or None if it is not installed"""
+    try:
+        dist = metadata.distribution(name)
+    except metadata.PackageNotFoundError:
+        return None
+    return dist.version, tuple(dist.requires or ())
 
 
 def get_file_content(path):
-    buffer = io .BytesIO()
     with open(path, 'rb') as f:
-        buffer.write(f.read())
-    return buffer.getvalue()
+        return f.read()
+
+
+def file_writer(path):
+    """Returns a writer copying the file at `path` into an archive entry,
+    see `generate_zip()`"""
+    def write(dest):
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, dest, COPY_BUFFER_SIZE)
+    return write
 
 
 def add_file_deps(files, include_files):
@@ -125,4 +482,5 @@ def add_file_deps(files, include_files):
         for f in include_files:
             fname = f'deps/{f}'
             logging.info(f'Adding file {fname}')
-            files.append((fname, get_file_content(f)))
+            # Read when the archive is generated, rather than held in memory
+            files.append((fname, file_writer(f)))
@@ -1,42 +1,50 @@
-import io
 import os
+import tempfile
 
-from blazee.utils import (SerializedModel, add_file_deps,
-                          get_files_dependencies, get_requirements)
+from blazee._optional import import_class
+from blazee.utils import (SerializedModel, add_file_deps, defined_in,
+                          get_model_metadata)
 
 
 def is_xgboost(model):
-    try:
-        from xgboost.core import Booster
-        return isinstance(model, Booster)
-    except:
+    if not defined_in(type(model), 'xgboost'):
         return False
+    return isinstance(model, import_class('xgboost.core', 'Booster'))
 
 
 def _get_model_metadata(model, include_files):
-    deps = ['xgboost']
-    return {
-        'lib_versions': get_requirements(deps),
-        'include_files': include_files
-    }
+    return get_model_metadata(['xgboost'], include_files)
 
 
-def serialize_xgboost(model, include_files):
-    tmp_file = 'tmp.txt'
+def _save_to_file(model):
+    # Older XGBoost versions can only save models to files.
+    # Use a unique file so concurrent serializations do not collide
+    fd, tmp_file = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
     try:
         model.save_model(tmp_file)
         with open(tmp_file, 'rb') as f:
-            buffer = f.read()
+            return f.read()
     finally:
         try:
             os.remove(tmp_file)
         except OSError:
             pass
 
-    files = [('model.txt', buffer)]
+
+def serialize_xgboost(model, include_files):
+    try:
+        # Saved in memory, as JSON which loads across XGBoost versions
+        files = [('model.json', bytes(model.save_raw(raw_format='json')))]
+        serialization_format = 'json'
+    except TypeError:
+        # No raw_format argument before XGBoost 1.3
+        files = [('model.txt', _save_to_file(model))]
+        serialization_format = 'binary'
 
     add_file_deps(files, include_files)
 
     meta = _get_model_metadata(model, include_files)
+    meta['format'] = serialization_format
 
     return SerializedModel('xgboost', meta, files)
@@ -56,6 +56,7 @@ setup(name='blazee',
       include_package_data=True,
       url='https://github.com/blazee-io/blazee-python',
       packages=find_packages(),
+      python_requires='>=3.8',
       install_requires=requires,
       tests_require=test_requirements,
       cmdclass={'test': PyTest},
@@ -71,9 +72,11 @@ setup(name='blazee',
           'Operating System :: MacOS',
           'Programming Language :: Python',
           'Programming Language :: Python :: 3',
-          'Programming Language :: Python :: 3.5',
-          'Programming Language :: Python :: 3.6',
-          'Programming Language :: Python :: 3.7',
+          'Programming Language :: Python :: 3.8',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
+          'Programming Language :: Python :: 3.12',
           'Topic :: Software Development',
           'Topic :: Scientific/Engineering',
       ])
@@ -1,9 +1,14 @@
+import gzip
+import json
 import uuid
 
 import pytest
 import responses
 from requests.exceptions import HTTPError
 
+from blazee.client import Client
+from blazee.utils import SerializedModel
+
 from .conftest import client, model_resp
 
 
@@ -41,6 +46,8 @@ def test_all_models(client, model_resp):
 def test_get_model_invalid_id(client):
     with pytest.raises(ValueError):
         client.get_model('my-id')
+    with pytest.raises(ValueError):
+        client.get_model(f'{uuid.uuid4()}\n')
 
 
 @responses.activate
@@ -75,3 +82,88 @@ def test_get_model(client, model_resp):
 
     model = client.get_model(model_id)
     assert model.default_version != None
+
+
+@responses.activate
+def test_api_call_not_modified(client):
+    responses.add(responses.GET, 'http://test/models',
+                  json=[], headers={'ETag': '"v1"'}, status=200)
+    responses.add(responses.GET, 'http://test/models', status=304)
+
+    assert client.all_models() == []
+    assert client.all_models() == []
+    assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+
+@responses.activate
+def test_api_call_not_modified_copy(client):
+    responses.add(responses.GET, 'http://test/models',
+                  json={'items': [1]}, headers={'ETag': '"v1"'}, status=200)
+    responses.add(responses.GET, 'http://test/models', status=304)
+
+    client._api_call('/models')['items'].append(2)
+    assert client._api_call('/models') == {'items': [1]}
+
+
+@responses.activate
+def test_api_call_etag_cache_size(client, monkeypatch):
+    monkeypatch.setattr('blazee.client.ETAG_CACHE_SIZE', 2)
+    for name in 'abc':
+        responses.add(responses.GET, f'http://test/models/{name}',
+                      json={}, headers={'ETag': f'"{name}"'}, status=200)
+        client._api_call(f'/models/{name}')
+
+    assert list(client._etags) == ['http://test/models/b',
+                                   'http://test/models/c']
+
+
+@responses.activate
+def test_api_call_gzip(client):
+    responses.add(responses.POST, 'http://test/models',
+                  json={}, status=200)
+
+    client._api_call('/models', method='POST', json={'name': 'small'})
+    client._api_call('/models', method='POST', json=[[0.5] * 10] * 1000)
+
+    assert 'Content-Encoding' not in responses.calls[0].request.headers
+    assert responses.calls[1].request.headers['Content-Encoding'] == 'gzip'
+    body = gzip.decompress(responses.calls[1].request.body)
+    assert json.loads(body) == [[0.5] * 10] * 1000
+
+
+@responses.activate
+def test_all_models_prefetch_versions(client, model_resp):
+    resp = [model_resp(), model_resp()]
+    responses.add(responses.GET, 'http://test/models',
+                  json=resp, status=200)
+    for m in resp:
+        responses.add(responses.GET, f"http://test/models/{m['id']}/versions",
+                      json=[], status=200)
+
+    models = client.all_models(prefetch_versions=True)
+    assert len(responses.calls) == 3
+    assert models[0].versions() == []
+    assert models[1].versions() == []
+    assert len(responses.calls) == 3
+
+
+def test_client_lzma_compresslevel():
+    with pytest.raises(ValueError):
+        Client(api_key='TEST_KEY', codec='lzma', compresslevel=5)
+
+
+def test_deploy_model_default_name(client, monkeypatch):
+    names = []
+
+    def create_model(type, model_name):
+        names.append(model_name)
+        raise RuntimeError('Stop before uploading')
+
+    monkeypatch.setattr(client, '_create_model', create_model)
+    serialized = SerializedModel('sklearn', {}, [])
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            client.deploy_model(serialized)
+
+    assert names[0] != names[1]
+    assert names[0].startswith('sklearn ')
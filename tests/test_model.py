@@ -1,12 +1,25 @@
+import json
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pytest
+import responses
 from requests.exceptions import HTTPError
-from sklearn.base import BaseEstimator
-from sklearn.linear_model import LinearRegression, LogisticRegressionCV
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.linear_model import (LinearRegression, LogisticRegression,
+                                  LogisticRegressionCV)
+from sklearn.model_selection import GridSearchCV
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
 
-from blazee import model
+from blazee import model, sklearn_utils
+from blazee.client import Client
+from blazee.utils import SerializedModel
 
-from .conftest import client
+from .conftest import client, model_resp, model_version_resp
 
 
 def test_serialize_invalid_model(client):
@@ -32,3 +45,307 @@ def test_serialize_untrained_model():
 
     with pytest.raises(AttributeError):
         model._serialize_model(clf)
+
+
+def test_serialize_serialized_model():
+    serialized = SerializedModel('sklearn', {}, [])
+
+    assert model._serialize_model(serialized) is serialized
+
+
+@responses.activate
+def test_predict_many(client, model_resp):
+    client.predict_batch_size = 2
+    bz_model = model.BlazeeModel(client, model_resp())
+
+    def predict_batch(request):
+        rows = json.loads(request.body)
+        return 200, {}, json.dumps([{'prediction': r[0]} for r in rows])
+
+    responses.add_callback(responses.POST,
+                           f'http://test/models/{bz_model.id}/predict_batch',
+                           callback=predict_batch)
+
+    preds = bz_model.predict_many([i] for i in range(5))
+    assert [p.prediction for p in preds] == [0, 1, 2, 3, 4]
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_batched_predictor(client, model_resp):
+    bz_model = model.BlazeeModel(client, model_resp())
+
+    def predict_batch(request):
+        rows = json.loads(request.body)
+        return 200, {}, json.dumps([{'prediction': r[0]} for r in rows])
+
+    responses.add_callback(responses.POST,
+                           f'http://test/models/{bz_model.id}/predict_batch',
+                           callback=predict_batch)
+
+    with bz_model.batched_predictor(max_batch_size=4, max_latency_ms=500) as predictor:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            preds = list(executor.map(lambda i: predictor.predict([i]),
+                                      range(8)))
+
+    assert [p.prediction for p in preds] == list(range(8))
+    assert len(responses.calls) == 2
+
+
+def test_batched_predictor_missing_predictions():
+    predictor = model.BatchingPredictor(lambda batch: batch[:-1],
+                                        max_batch_size=2, max_latency_ms=500)
+    with predictor, ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(predictor.predict, [i]) for i in range(2)]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result(timeout=5)
+
+    with pytest.raises(AssertionError):
+        predictor.predict([0])
+
+
+@responses.activate
+def test_predict_coalesce(client, model_resp):
+    bz_model = model.BlazeeModel(client, model_resp())
+    started = threading.Barrier(4)
+
+    def predict(request):
+        time.sleep(0.2)
+        return 200, {}, json.dumps({'prediction': 1})
+
+    responses.add_callback(responses.POST,
+                           f'http://test/models/{bz_model.id}/predict',
+                           callback=predict)
+
+    def coalesced_predict(_):
+        started.wait()
+        return bz_model.predict([1, 2], coalesce=True)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        preds = list(executor.map(coalesced_predict, range(4)))
+
+    assert [p.prediction for p in preds] == [1] * 4
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_predict_coalesce_per_api_key(client, model_resp):
+    resp = model_resp()
+    other_client = Client(api_key='OTHER_KEY', host='http://test')
+    bz_models = [model.BlazeeModel(client, resp),
+                 model.BlazeeModel(other_client, resp)]
+    started = threading.Barrier(2)
+
+    def predict(request):
+        time.sleep(0.2)
+        return 200, {}, json.dumps({'prediction': request.headers['X-Api-Key']})
+
+    responses.add_callback(responses.POST,
+                           f"http://test/models/{resp['id']}/predict",
+                           callback=predict)
+
+    def coalesced_predict(bz_model):
+        started.wait()
+        return bz_model.predict([1, 2], coalesce=True)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        preds = list(executor.map(coalesced_predict, bz_models))
+
+    assert [p.prediction for p in preds] == ['TEST_KEY', 'OTHER_KEY']
+    assert len(responses.calls) == 2
+
+
+def test_serialize_quantized_model():
+    X = np.random.rand(20, 3)
+    clf = LinearRegression().fit(X, X.sum(axis=1))
+
+    serialized = model._serialize_model(clf, quantize='fp32')
+    assert serialized.metadata['quantize'] == 'fp32'
+    assert clf.coef_.dtype == np.float64
+
+    with pytest.raises(ValueError):
+        model._serialize_model(clf, quantize='int4')
+
+
+def test_serialize_untrained_pipeline():
+    pipeline = Pipeline([('scale', StandardScaler()),
+                         ('clf', LogisticRegressionCV())])
+
+    with pytest.raises(AttributeError):
+        model._serialize_model(pipeline)
+
+
+class Select(BaseEstimator, TransformerMixin):
+    def __init__(self, column=0):
+        self.column = column
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return np.asarray(X)[:, [self.column]]
+
+
+def test_serialize_stateless_pipeline_step():
+    pipeline = Pipeline([('select', Select()),
+                         ('clf', LinearRegression())])
+    pipeline.fit([[1, 2], [2, 3], [3, 5]], [1, 2, 3])
+
+    serialized = model._serialize_model(pipeline)
+    assert serialized.type == 'sklearn'
+
+
+def test_serialize_stateless_model():
+    serialized = model._serialize_model(Select(column=1).fit([[1, 2]]))
+    assert serialized.type == 'sklearn'
+
+
+@responses.activate
+def test_predict_batch_chunks(client, model_resp):
+    bz_model = model.BlazeeModel(client, model_resp())
+
+    def predict_batch(request):
+        rows = json.loads(request.body)
+        return 200, {}, json.dumps([{'prediction': r[0]} for r in rows])
+
+    responses.add_callback(responses.POST,
+                           f'http://test/models/{bz_model.id}/predict_batch',
+                           callback=predict_batch)
+
+    preds = bz_model.predict_batch(np.arange(10).reshape(10, 1), chunk_size=4)
+    assert [p.prediction for p in preds] == list(range(10))
+    assert len(responses.calls) == 3
+
+
+@responses.activate
+def test_predict_batch_msgpack(client, model_resp):
+    msgpack = pytest.importorskip('msgpack')
+    bz_model = model.BlazeeModel(client, model_resp())
+
+    def predict_batch(request):
+        assert request.headers['Content-Type'] == 'application/msgpack'
+        rows = msgpack.unpackb(request.body)
+        return 200, {}, json.dumps([{'prediction': r[0]} for r in rows])
+
+    responses.add_callback(responses.POST,
+                           f'http://test/models/{bz_model.id}/predict_batch',
+                           callback=predict_batch)
+
+    preds = bz_model.predict_batch(np.arange(4.).reshape(4, 1), format='msgpack')
+    assert [p.prediction for p in preds] == [0., 1., 2., 3.]
+    with pytest.raises(ValueError):
+        bz_model.predict_batch([[1]], format='xml')
+
+
+@responses.activate
+def test_get_version(client, model_resp, model_version_resp):
+    bz_model = model.BlazeeModel(client, model_resp())
+    versions = [model_version_resp(), model_version_resp()]
+    versions[1]['name'] = 'v2'
+    for v in versions:
+        v['deployment_error'] = None
+    responses.add(responses.GET, f'http://test/models/{bz_model.id}/versions',
+                  json=versions, status=200)
+
+    assert bz_model.get_version('v2').id == versions[1]['id']
+    assert bz_model.get_version(versions[0]['id']).name == 'v1'
+    with pytest.raises(ValueError):
+        bz_model.get_version('v3')
+    assert len(responses.calls) == 1
+
+
+@responses.activate
+def test_get_version_by_id_fallback(client, model_resp, model_version_resp):
+    bz_model = model.BlazeeModel(client, model_resp())
+    version = {**model_version_resp(), 'deployment_error': None}
+    base_url = f'http://test/models/{bz_model.id}/versions'
+    # e.g. an error page from a proxy
+    responses.add(responses.GET, f"{base_url}/{version['id']}",
+                  body='<html>Not Found</html>', status=404)
+    responses.add(responses.GET, base_url, json=[version], status=200)
+
+    assert bz_model.get_version(version['id']).id == version['id']
+    assert len(responses.calls) == 2
+
+
+@responses.activate
+def test_rename(client, model_resp):
+    resp = model_resp()
+    bz_model = model.BlazeeModel(client, resp)
+    url = f'http://test/models/{bz_model.id}'
+    responses.add(responses.PATCH, url,
+                  json={**resp, 'name': 'renamed'}, status=200)
+
+    bz_model.rename('renamed')
+    assert bz_model.name == 'renamed'
+    assert len(responses.calls) == 1
+
+    # Falls back to fetching the model when it is not returned
+    responses.replace(responses.PATCH, url, json={}, status=200)
+    responses.add(responses.GET, url,
+                  json={**resp, 'name': 'fetched'}, status=200)
+    bz_model.rename('fetched')
+    assert bz_model.name == 'fetched'
+    assert len(responses.calls) == 3
+
+
+def test_serialize_pickle_buffers():
+    X = np.random.rand(20, 3)
+    clf = LinearRegression().fit(X, X.sum(axis=1))
+
+    serialized = sklearn_utils.serialize_sklearn(clf, None, format='pickle')
+    files = dict(serialized.files)
+    assert serialized.metadata['format'] == 'pickle'
+    assert len(files) == serialized.metadata['pickle_buffers'] + 1
+    buffers = [files[f'buffers/{i}.bin']
+               for i in range(serialized.metadata['pickle_buffers'])]
+    loaded = pickle.loads(files['model.pickle'], buffers=buffers)
+    assert np.array_equal(loaded.coef_, clf.coef_)
+
+
+def test_serialize_search_without_refit():
+    X = np.random.rand(20, 3)
+    search = GridSearchCV(LinearRegression(), {'fit_intercept': [True, False]},
+                          cv=2, refit=False).fit(X, X.sum(axis=1))
+
+    with pytest.raises(AttributeError):
+        model._serialize_model(search)
+
+    search.set_params(refit=True).fit(X, X.sum(axis=1))
+    assert model._serialize_model(search).type == 'sklearn'
+
+
+@responses.activate
+def test_update_polls_version(client, model_resp, model_version_resp, monkeypatch):
+    monkeypatch.setattr(model.time, 'sleep', lambda _: None)
+    resp = model_resp()
+    bz_model = model.BlazeeModel(client, resp)
+    version = {**model_version_resp(deployed=False),
+               'deployment_error': None,
+               'upload_data': {'url': 'http://upload', 'fields': {}}}
+    base_url = f'http://test/models/{bz_model.id}'
+    responses.add(responses.POST, f'{base_url}/versions', json=version)
+    responses.add(responses.POST, 'http://upload')
+    # The deploy response is not relied upon
+    responses.add(responses.PATCH, f"{base_url}/versions/{version['id']}/deploy",
+                  json={})
+    responses.add(responses.GET, f"{base_url}/versions/{version['id']}",
+                  json={**version, 'deployed': True})
+    responses.add(responses.GET, base_url, json=resp)
+
+    bz_model.update(SerializedModel('sklearn', {}, [('model.joblib', b'model')]))
+    assert responses.calls[-2].request.url == \
+        f"{base_url}/versions/{version['id']}"
+
+
+def test_serialize_quantized_model_float_labels():
+    X = np.random.rand(20, 3)
+    # Not representable in float16
+    y = np.array([2049., 4097.] * 10)
+    clf = LogisticRegression().fit(X, y)
+
+    quantized = sklearn_utils._quantize(clf, 'fp16')
+    assert quantized.coef_.dtype == np.float16
+    assert quantized.classes_.dtype == np.float64
+    assert set(quantized.predict(X)) <= {2049., 4097.}
@@ -1,33 +1,34 @@
-from __future__ import print_function
-
 import logging
-from pprint import pprint
+import os
+from pprint import pformat
 from time import time
 
+import joblib
+import pytest
 from sklearn.datasets import fetch_20newsgroups
 from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
 from sklearn.linear_model import SGDClassifier
 from sklearn.model_selection import GridSearchCV
 from sklearn.pipeline import Pipeline
+from sklearn.utils import Bunch
 
 from .conftest import client
 
-# def test_pipeline(client):
-#     data, pipeline = create_test_pipeline()
-#     y = pipeline.predict(data.data)
-
-#     model = client.deploy_model(pipeline)
+logger = logging.getLogger(__name__)
 
-#     p = model.predict(data.data[0])
-#     assert p.prediction == y[0]
-#     assert p.probas == None
 
+@pytest.fixture(scope='session')
+def trained_pipeline():
+    """Trains the test pipeline once per session, and caches it on disk
+    across runs. Set BLAZEE_FAST_TESTS=1 to train it on a tiny synthetic
+    dataset with a single point grid instead."""
+    memory = joblib.Memory(location=os.path.join('.pytest_cache', 'pipeline'),
+                           verbose=0)
+    fast = os.environ.get('BLAZEE_FAST_TESTS') == '1'
+    return memory.cache(create_test_pipeline)(fast=fast)
 
-def create_test_pipeline():
-    # Display progress logs on stdout
-    logging.basicConfig(level=logging.INFO,
-                        format='%(asctime)s %(levelname)s %(message)s')
 
+def create_test_pipeline(fast=False):
     # #############################################################################
     # Load some categories from the training set
     categories = [
@@ -37,13 +38,20 @@ def create_test_pipeline():
     # Uncomment the following to do the analysis on all the categories
     #categories = None
 
-    print("Loading 20 newsgroups dataset for categories:")
-    print(categories)
+    logger.info("Loading 20 newsgroups dataset for categories: %s", categories)
 
-    data = fetch_20newsgroups(subset='train', categories=categories)
-    print("%d documents" % len(data.filenames))
-    print("%d categories" % len(data.target_names))
-    print()
+    if fast:
+        # A few synthetic documents, enough to exercise the pipeline
+        data = Bunch(data=['god exists', 'there is no god', 'faith matters',
+                           'religion is belief', 'prayer and faith',
+                           'atheism is a position', 'no belief in gods',
+                           'reason over faith', 'doubt everything',
+                           'evidence first'],
+                     target=[1, 0, 1, 1, 1, 0, 0, 0, 0, 0])
+    else:
+        data = fetch_20newsgroups(subset='train', categories=categories)
+        logger.info("%d documents", len(data.filenames))
+        logger.info("%d categories", len(data.target_names))
 
     # #############################################################################
     # Define a pipeline combining a text feature extractor with a simple
@@ -67,21 +75,33 @@ def create_test_pipeline():
         'clf__penalty': ('l2', 'elasticnet'),
         # 'clf__max_iter': (10, 50, 80),
     }
-    grid_search = GridSearchCV(pipeline, parameters, cv=5,
+    if fast:
+        # Single point grid
+        parameters = {name: values[:1] for name, values in parameters.items()}
+    grid_search = GridSearchCV(pipeline, parameters, cv=2 if fast else 5,
                                n_jobs=-1, verbose=1)
 
-    print("Performing grid search...")
-    print("pipeline:", [name for name, _ in pipeline.steps])
-    print("parameters:")
-    pprint(parameters)
+    logger.info("Performing grid search...")
+    logger.info("pipeline: %s", [name for name, _ in pipeline.steps])
+    logger.info("parameters:\n%s", pformat(parameters))
     t0 = time()
     grid_search.fit(data.data, data.target)
-    print("done in %0.3fs" % (time() - t0))
-    print()
+    logger.info("done in %0.3fs", time() - t0)
 
-    print("Best score: %0.3f" % grid_search.best_score_)
-    print("Best parameters set:")
+    logger.info("Best score: %0.3f", grid_search.best_score_)
+    logger.info("Best parameters set:")
     best_parameters = grid_search.best_estimator_.get_params()
     for param_name in sorted(parameters.keys()):
-        print("\t%s: %r" % (param_name, best_parameters[param_name]))
+        logger.info("\t%s: %r", param_name, best_parameters[param_name])
     return data, grid_search.best_estimator_
+
+
+# def test_pipeline(client, trained_pipeline):
+#     data, pipeline = trained_pipeline
+#     y = pipeline.predict(data.data)
+
+#     model = client.deploy_model(pipeline)
+
+#     p = model.predict(data.data[0])
+#     assert p.prediction == y[0]
+#     assert p.probas == None
@@ -0,0 +1,245 @@
+import datetime
+import io
+import json
+import os
+import sys
+import tarfile
+import zipfile
+
+import numpy as np
+import pytest
+import requests
+
+from blazee import utils
+
+FILES = [('model.pickle', b'model' * 1000), ('deps/model.py', b'import os')]
+
+
+@pytest.mark.parametrize('codec', ['deflate', 'lzma'])
+def test_generate_archive_zip(codec):
+    with utils.generate_archive(FILES, codec) as archive:
+        zf = zipfile.ZipFile(archive)
+        assert [(name, zf.read(name)) for name in zf.namelist()] == FILES
+
+
+def test_generate_archive_zstd():
+    zstandard = pytest.importorskip('zstandard')
+    with utils.generate_archive(FILES, 'zstd') as archive:
+        reader = zstandard.ZstdDecompressor().stream_reader(archive)
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            assert [(m.name, tar.extractfile(m).read()) for m in tar] == FILES
+
+
+def test_generate_archive_invalid_codec():
+    with pytest.raises(ValueError):
+        utils.generate_archive(FILES, 'bz2')
+
+
+def test_generate_zip_file_objects():
+    content = io.BytesIO(b'model' * 1000)
+    content.read()
+
+    with utils.generate_zip([('model.pickle', content)]) as archive:
+        assert zipfile.ZipFile(archive).read('model.pickle') == b'model' * 1000
+
+
+@pytest.mark.parametrize('codec', ['deflate', 'zstd'])
+def test_generate_archive_writers(codec):
+    if codec == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+
+    def write(fh):
+        for _ in range(1000):
+            fh.write(b'model')
+
+    with utils.generate_archive([('model.pickle', write)], codec) as archive:
+        if codec == 'zstd':
+            reader = zstandard.ZstdDecompressor().stream_reader(archive)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                member = tar.next()
+                assert tar.extractfile(member).read() == b'model' * 1000
+        else:
+            assert zipfile.ZipFile(archive).read('model.pickle') == b'model' * 1000
+
+
+def test_generate_zip_compressed():
+    with utils.generate_zip(FILES) as archive:
+        zinfo = zipfile.ZipFile(archive).getinfo('model.pickle')
+        assert zinfo.compress_type == zipfile.ZIP_DEFLATED
+        assert zinfo.compress_size < zinfo.file_size
+
+
+@pytest.mark.parametrize('content', [
+    b'model' * 1000,
+    io.BytesIO(b'model' * 1000),
+    lambda fh: fh.write(b'model' * 1000),
+])
+def test_generate_archive_deflated(content):
+    with utils.generate_archive([('model.pickle', content)], 'deflate') as archive:
+        zf = zipfile.ZipFile(archive)
+        zinfo = zf.getinfo('model.pickle')
+        assert zinfo.compress_type == zipfile.ZIP_DEFLATED
+        assert zinfo.compress_size < zinfo.file_size
+        assert zf.read('model.pickle') == b'model' * 1000
+
+
+def test_parse_datetime():
+    tz = datetime.timezone.utc
+    assert utils.parse_datetime('2020-01-02T03:04:05Z') == \
+        datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=tz)
+    assert utils.parse_datetime('2020-01-02T03:04:05.123456') == \
+        datetime.datetime(2020, 1, 2, 3, 4, 5, 123456)
+    # Not supported by fromisoformat before Python 3.11
+    assert utils.parse_datetime('20200102T030405Z') == \
+        datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=tz)
+
+
+def test_json_dumps_pandas():
+    pd = pytest.importorskip('pandas')
+    df = pd.DataFrame({'a': [1, 2], 'b': [0.5, 1.5]})
+    assert json.loads(utils.json_dumps({'data': df})) == \
+        {'data': [[1, 0.5], [2, 1.5]]}
+    assert json.loads(utils.json_dumps(df['a'])) == [1, 2]
+
+
+def test_json_dumps_non_finite():
+    content = utils.json_dumps({'a': float('nan'), 'b': None,
+                                'c': np.array([1.0, np.inf])})
+    assert content.replace(b' ', b'') == \
+        b'{"a":NaN,"b":null,"c":[1.0,Infinity]}'
+    assert utils.json_dumps([None, 1.5]).replace(b' ', b'') == b'[null,1.5]'
+
+
+def test_json_dumps_non_str_keys():
+    assert json.loads(utils.json_dumps({1: 'a', 2.5: 'b'})) == \
+        {'1': 'a', '2.5': 'b'}
+
+
+def test_json_loads_non_finite():
+    values = utils.json_loads(b'{"a": NaN, "b": [Infinity, 1]}')
+    assert np.isnan(values['a'])
+    assert values['b'] == [float('inf'), 1]
+
+    with pytest.raises(ValueError):
+        utils.json_loads(b'{"a": ')
+
+
+def test_get_requirements():
+    requirements = utils.get_requirements(['requests'])
+    assert requirements['requests'] == requests.__version__
+    assert 'urllib3' in requirements
+    # Only required by the 'socks' extra
+    assert 'PySocks' not in requirements
+
+
+def test_generate_archive_compresslevel():
+    content = bytes(range(256)) * 1000
+    with utils.generate_archive([('model.pickle', content)], 'deflate',
+                                compresslevel=0) as archive:
+        zinfo = zipfile.ZipFile(archive).getinfo('model.pickle')
+        assert zinfo.compress_size >= zinfo.file_size
+
+    with pytest.raises(ValueError):
+        utils.generate_archive(FILES, 'lzma', compresslevel=5)
+
+
+def test_generate_zip_compresslevel():
+    content = bytes(range(256)) * 1000
+    sizes = []
+    for level in (0, 9):
+        with utils.generate_zip([('model.pickle', content)],
+                                compresslevel=level) as archive:
+            zinfo = zipfile.ZipFile(archive).getinfo('model.pickle')
+            sizes.append(zinfo.compress_size)
+    assert sizes[1] < sizes[0]
+
+
+def test_get_file_dependencies(tmp_path):
+    path = tmp_path / 'model.py'
+    path.write_text('import numpy as np\n'
+                    'from requests.adapters import HTTPAdapter\n'
+                    'from . import layers\n'
+                    'import os, sys\n'
+                    'try:\n'
+                    '    import urllib3.util\n'
+                    'except ImportError:\n'
+                    '    pass\n'
+                    'from joblib import (\n'
+                    '    dump,\n'
+                    ')\n'
+                    '"""\n'
+                    'import pandas\n'
+                    '"""\n')
+    assert utils.get_file_dependencies(str(path)) == \
+        {'numpy', 'requests', 'urllib3', 'joblib'}
+
+
+def test_add_file_deps(tmp_path):
+    path = tmp_path / 'model.py'
+    path.write_bytes(b'import os\n')
+    files = []
+    utils.add_file_deps(files, [str(path)])
+
+    with utils.generate_zip(files) as archive:
+        assert zipfile.ZipFile(archive).read(f'deps/{path}') == b'import os\n'
+
+
+@pytest.mark.parametrize('num_bytes, expected', [
+    (0, '0 B'),
+    (1023, '1023 B'),
+    (1024, '1.0 KB'),
+    (1536, '1.5 KB'),
+    (5 * 1024 ** 2, '5.0 MB'),
+    (3 * 1024 ** 3, '3.0 GB'),
+    (2048 * 1024 ** 4, '2048.0 TB'),
+])
+def test_pretty_size(num_bytes, expected):
+    assert utils.pretty_size(num_bytes) == expected
+
+
+def test_numpy_encoder():
+    np = pytest.importorskip('numpy')
+    data = {'array': np.arange(3, dtype=np.int32),
+            'scalars': [np.float32(0.5), np.int8(1), np.bool_(True)]}
+    assert json.loads(json.dumps(data, cls=utils.NumpyEncoder)) == \
+        {'array': [0, 1, 2], 'scalars': [0.5, 1, True]}
+    with pytest.raises(TypeError):
+        json.dumps(object(), cls=utils.NumpyEncoder)
+
+
+def test_generate_zip_stores_incompressible():
+    files = [('weights.bin', os.urandom(100000)), *FILES]
+    with utils.generate_zip(files) as archive:
+        zf = zipfile.ZipFile(archive)
+        assert zf.getinfo('weights.bin').compress_type == zipfile.ZIP_STORED
+        assert zf.getinfo('model.pickle').compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read('weights.bin') == files[0][1]
+
+
+def test_parse_import():
+    assert utils.parse_import('numpy.linalg') == 'numpy'
+    assert utils.parse_import('os.path') is None
+    assert utils.parse_import('.layers') is None
+    assert utils.parse_import('not_installed_module') is None
+
+
+def test_get_file_dependencies_not_python(tmp_path):
+    vocab = tmp_path / 'vocab.txt'
+    vocab.write_text('import this\nnot python (\n')
+    invalid = tmp_path / 'invalid.py'
+    invalid.write_text('import numpy\ndef (\n')
+    assert utils.get_file_dependencies(str(vocab)) == set()
+    assert utils.get_file_dependencies(str(invalid)) == set()
+
+
+def test_stdlib_modules_fallback(monkeypatch):
+    # As on Python < 3.10
+    monkeypatch.delattr(sys, 'stdlib_module_names', raising=False)
+    utils._stdlib_modules.cache_clear()
+    try:
+        modules = utils._stdlib_modules()
+        assert {'os', 'json', 're', 'zipfile', 'sys'} <= modules
+        assert 'numpy' not in modules
+    finally:
+        monkeypatch.undo()
+        utils._stdlib_modules.cache_clear()